@@ -2,14 +2,14 @@ from pypylon import pylon
 import cv2 as cv
 import numpy as np
 import math
+import os
 from numpy.core.fromnumeric import shape 
 import imutils
 import time
-from scipy import ndimage
+import queue
+import threading
+from functools import lru_cache
 import tensorflow as tf
-import tensorflow.keras as keras
-from tensorflow.keras.preprocessing import image
-from keras.models import model_from_json
 
 '''
 Program for embedded ADLINK NEON 2000 Smart Camera. Use Basler pylon to grab the frames.
@@ -23,6 +23,27 @@ PX2MM = 580/4 #R = 4mm R = 620px (based on the round of the cutting insert)
 MAX_DIM = 137 # Max radius of the cutting insert [px]
 MIN_DIM = 128 # Min radius of the cutting insert [px]
 STD_ERROR = 1.5 # Max std error for edge of the cutting insert [px]
+POLAR_R = (int(PX2MM*1),int(PX2MM*2.25)) # Radius range of the arc polar transform [px]
+POLAR_THETA = 90 # Angle range of the arc polar transform [deg]
+POLAR_THETA_INC = 0.25 # Angle step of the arc polar transform [deg]
+DEBUG = False # Draw and show intermediate steps of the classic algorithm
+LINE_THRESH = 150 # Brightness threshold applied before searching for the edge
+LINE_INLIER = 3 # Max distance of the edge point from the RANSAC line [px]
+LINE_ITERS = 64 # Number of the RANSAC candidate lines
+MODEL_PATHS = ('model_int8.tflite','model_fp16.tflite') # Deep learning models, the faster one is used
+MODEL_CACHE = 'model_choice.txt' # Model chosen on this target
+
+# Separable lines filtration kernels
+LINE_KERNEL = np.array([-2,-1,1,6,1,-1,-2], dtype=np.float32)
+ONES_5 = np.ones(5, dtype=np.float32)
+ONES_7 = np.ones(7, dtype=np.float32)
+OPEN_KERNEL = np.ones((7,7), dtype=np.uint8) # Morphological opening in findLinesPoints
+
+# Counterclockwise arc ROI rotations
+ROTATIONS = {90: cv.ROTATE_90_COUNTERCLOCKWISE, 180: cv.ROTATE_180, 270: cv.ROTATE_90_CLOCKWISE}
+
+# Random generator of the RANSAC line fit, seeded to get repeatable results
+line_rng = np.random.default_rng(0)
 
 
 #------------------Configuration--------------------#
@@ -33,42 +54,125 @@ camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
 camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly) 
 converter = pylon.ImageFormatConverter()
 
-# Converting to opencv bgr format
-converter.OutputPixelFormat = pylon.PixelType_BGR8packed
+# Converting to opencv grayscale format
+converter.OutputPixelFormat = pylon.PixelType_Mono8
 converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
 
-# Loading neural network model (it takes soome time)
+# Frames grabbed in the background thread (only the latest one is kept)
+frames = queue.Queue(maxsize=1)
+stop_grabbing = threading.Event()
+
+# Deep learning jobs and results exchanged with the inference thread, tagged with frame id
+dl_in = queue.Queue()
+dl_out = queue.Queue()
+
+# Loading neural network model converted by tflite_export.py
+# TF x86 builds should run it with XNNPACK delegate, plain quantized kernels can be slower there
 start_time = time.time()
-json_file = open("model.json", 'r')
-loaded_model_json = json_file.read()
-json_file.close()
-model = model_from_json(loaded_model_json)
-model.load_weights("model.h5")
-print("Model loaded sucesfully in",time.time()-start_time,"s")
+model_path = None
+if os.path.exists(MODEL_CACHE):
+    with open(MODEL_CACHE, 'r') as f:
+        cached_path = f.read().strip()
+    # Cached choice is dropped if the model is gone or any model was exported again after the benchmark
+    cache_time = os.path.getmtime(MODEL_CACHE)
+    if(cached_path in MODEL_PATHS and os.path.exists(cached_path)
+       and all(os.path.getmtime(path) <= cache_time for path in MODEL_PATHS if os.path.exists(path))):
+        model_path = cached_path
+if model_path is None:
+    # Int8 can be slower than float on CPUs without dot product instructions - measure both
+    timings = {}
+    for path in MODEL_PATHS:
+        if not os.path.exists(path):
+            print(path,"not found, skipped")
+            continue
+        interp = tf.lite.Interpreter(path, num_threads=4)
+        interp.allocate_tensors()
+        in_details = interp.get_input_details()[0]
+        interp.set_tensor(in_details['index'], np.zeros(in_details['shape'], dtype=in_details['dtype']))
+        interp.invoke() # Warm up
+        bench_time = time.perf_counter()
+        for i in range(10): interp.invoke()
+        timings[path] = time.perf_counter() - bench_time
+        print("{}: \t {:.3f}s per frame".format(path,timings[path]/10))
+    if not timings:
+        raise FileNotFoundError("None of the models {} found, run tflite_export.py".format(MODEL_PATHS))
+    model_path = min(timings, key=timings.get)
+    with open(MODEL_CACHE, 'w') as f:
+        f.write(model_path)
+interp = tf.lite.Interpreter(model_path, num_threads=4)
+interp.allocate_tensors()
+in_details = interp.get_input_details()[0]
+out_idx = interp.get_output_details()[0]['index']
+
+# Input normalization x/255 and int8 quantization x/scale + zero_point merged into one scale
+if in_details['dtype'] == np.uint8:
+    scale, zero_point = in_details['quantization']
+    in_mul, in_add = np.float32(1/(255*scale)), np.float32(zero_point)
+else:
+    in_mul, in_add = np.float32(1/255), np.float32(0)
+print("Model",model_path,"loaded sucesfully in",time.time()-start_time,"s")
 #---------------Configuration-end------------------#
 
 
 #--------------------Functions---------------------#
+# Buffers
+class Pipeline:
+    '''
+    Buffers reused by the processing functions across the frames instead of allocating new ones.
+    Polar buffer is sized for the arc polar transform parameters, preview buffer for the first frame.
+    '''
+
+    def __init__(self,r=POLAR_R,theta=POLAR_THETA,theta_inc=POLAR_THETA_INC):
+        self.arc_buf = np.zeros((int(r[1]-r[0]),int(theta/theta_inc)+1), dtype=np.uint8) # polarTransform output
+        self.overlay_buf = None # Preview of the frame
+
+    def overlay(self,image):
+        '''
+        Return copy of the frame in the preview buffer.
+        '''
+        if(self.overlay_buf is None or self.overlay_buf.shape != image.shape):
+            self.overlay_buf = np.empty_like(image)
+        np.copyto(self.overlay_buf, image)
+        return self.overlay_buf
+
 # Clasic image processing
 def linesFiltration(roi,direction):
     '''
     Apply 2d filters to the image with help to highlight straight lines.
     Kernels are chosen based of the lines' orientation.
     '''
-    # Define kernels
-    a = [-2,-1,1,6,1,-1,-2]
-    kernel1 = np.array([[a[0],a[0],a[0],a[0],a[0],a[0],a[0]],[a[1],a[1],a[1],a[1],a[1],a[1],a[1]],[a[2],a[2],a[2],a[2],a[2],a[2],a[2]],
-                       [a[3],a[3],a[3],a[3],a[3],a[3],a[3]],
-                       [a[2],a[2],a[2],a[2],a[2],a[2],a[2]],[a[1],a[1],a[1],a[1],a[1],a[1],a[1]],[a[0],a[0],a[0],a[0],a[0],a[0],a[0]]])
-    kernel2 = np.array([a,a,a,a,a])
-    
     # Chose kernel proper for defined direction
-    if(direction[1]!=0): kernel = kernel1
-    if(direction[0]!=0): kernel = kernel2
-    roi2 = cv.filter2D(roi,-1,kernel)
+    # 7x7 kernel with LINE_KERNEL columns or 5x7 kernel with LINE_KERNEL rows, both are separable
+    if(direction[1]!=0): roi2 = cv.sepFilter2D(roi,-1,ONES_7,LINE_KERNEL)
+    if(direction[0]!=0): roi2 = cv.sepFilter2D(roi,-1,LINE_KERNEL,ONES_5)
     #showResizedImg(roi2,'linesFiltration',scale = 2 )
     return roi2
 
+def scanView(roi,direction):
+    '''
+    Return view of the roi in which searching direction runs along the rows from the left.
+    No data is copied.
+    '''
+    if(direction[0] == 1): return roi
+    if(direction[0] == -1): return roi[:,::-1]
+    if(direction[1] == 1): return roi[::-1].T
+    return roi.T
+
+def scanPoints(idx,valid,direction,shape):
+    '''
+    Map indexes of the first edge points found in the scanView back to the roi coordinates.
+    Return them in the cv.findNonZero format (None if there are no points).
+    '''
+    if(not valid.any()): return None
+    lines = np.flatnonzero(valid)
+    idx = idx[valid]
+    rows,cols = shape
+    if(direction[0] == 1): x,y = idx, lines
+    elif(direction[0] == -1): x,y = cols-1-idx, lines
+    elif(direction[1] == 1): x,y = lines, rows-1-idx
+    else: x,y = lines, idx
+    return np.stack((x,y),axis=1).astype(np.int32)[:,None,:]
+
 def findLinesPoints(roi,direction):   
     '''
     Return coordinates of the points with belongs to the edge.
@@ -76,37 +180,18 @@ def findLinesPoints(roi,direction):
     '''
     
     # Some preprocessing
-    kernel = np.ones((7,7),np.uint8)
-    roi = cv.morphologyEx(roi, cv.MORPH_OPEN, kernel)
+    roi = cv.morphologyEx(roi, cv.MORPH_OPEN, OPEN_KERNEL)
     roi = cv.Canny(roi,100,30)
 
     #showResizedImg(roi,'findLinesPoints1',scale = 2 ) 
 
-    # Rotate image to ensure proper searching direction
-    if(direction[0] == -1): roi = cv.flip(roi, 1) 
-    if(direction[1] != 0): 
-        roi =  cv.rotate(roi, cv.ROTATE_90_CLOCKWISE)
-        if(direction[1] == -1): roi = cv.flip(roi, 1)  
-
-    # Find min non zero val in each row
-    rows,cols = roi.shape
-    drawing = np.zeros((rows, cols), dtype=np.uint8)
-    for r in range(rows):
-        non_zero_values=np.flatnonzero(roi[r])
-        if any(non_zero_values): 
-            drawing.itemset((r,non_zero_values[0]),255)
-
-    # Rotate image to go back to the base coordinates
-    if(direction[0] == -1): drawing = cv.flip(drawing, 1) 
-    if(direction[1] != 0): 
-        if(direction[1] == -1): drawing = cv.flip(drawing, 1) 
-        drawing =  cv.rotate(drawing, cv.ROTATE_90_COUNTERCLOCKWISE)
-         
-    # Find outer line points 
-    pts = []
-    pts = cv.findNonZero(drawing)
-
-    #showResizedImg(drawing,'findLinesPoints2',scale = 2 )     
+    # Find min non zero val in each line along searching direction (view instead of rotated copy)
+    mask = scanView(roi.astype(bool),direction)
+    idx = mask.argmax(axis=1) # first non zero value in each line
+    valid = mask.any(axis=1) # lines with at least one non zero value
+
+    # Find outer line points in the base coordinates
+    pts = scanPoints(idx,valid,direction,roi.shape)
     return pts
 
 def searchingBox(image, points, direction=(0,1)):
@@ -119,10 +204,9 @@ def searchingBox(image, points, direction=(0,1)):
     # Specify ROI
     pts = (points[0],(points[0]+points[2]),points[1],(points[1]+points[3]))
     # Apply ROI
-    roi = image.copy()[pts[2]:pts[3],pts[0]:pts[1]]
-    # Treshold
-    ret,roi = cv.threshold(roi,150,255,cv.THRESH_TOZERO)
+    roi = image[pts[2]:pts[3],pts[0]:pts[1]] # view, the frame is not drawn on until drawLine
     # Find points with belongs to the edge
+    ret,roi = cv.threshold(roi,LINE_THRESH,255,cv.THRESH_TOZERO)
     roi = linesFiltration(roi,direction)
     pts = findLinesPoints(roi,direction)
    
@@ -132,26 +216,52 @@ def searchingBox(image, points, direction=(0,1)):
         return -1,-1,-1,-1  
 
     # Fit line
-    vector = np.array(pts)
-    vx,vy,x,y = cv.fitLine(vector,cv.DIST_HUBER, 0, 0.01, 0.05) 
+    vx,vy,x,y = fitEdgeLine(pts)
     
     # Go back to the global coordinate system  
     x = x + points[0]   
     y = y + points[1]
     line = vx,vy,x,y
+    return line 
+
+def fitEdgeLine(pts):
+    '''
+    Fit line to the edge points found by findLinesPoints.
+    RANSAC on a 20% subsample rejects points of the contaminations, then the inliers are fitted with DIST_L2.
+    Cheaper than the iterative DIST_HUBER fit.
+    '''
+    p = pts[:,0].astype(np.float32)
+    sample = p[line_rng.integers(0,len(p),max(len(p)//5,2))]
+
+    # Candidate lines nx*x + ny*y + c = 0 through random pairs of the sample points
+    a = sample[line_rng.integers(0,len(sample),LINE_ITERS)]
+    b = sample[line_rng.integers(0,len(sample),LINE_ITERS)]
+    nx, ny = a[:,1]-b[:,1], b[:,0]-a[:,0]
+    c = -(nx*a[:,0] + ny*a[:,1])
+    dist = np.abs(np.outer(nx,sample[:,0]) + np.outer(ny,sample[:,1]) + c[:,None])
+    best = int(np.argmax((dist < LINE_INLIER*np.hypot(nx,ny)[:,None]).sum(axis=1)))
+
+    # Polish the best candidate with L2 fit on all its inliers
+    inliers = np.abs(nx[best]*p[:,0] + ny[best]*p[:,1] + c[best]) < LINE_INLIER*math.hypot(nx[best],ny[best])
+    if(inliers.sum() < 2): inliers[:] = True # Degenerate sample
+    return cv.fitLine(pts[inliers], cv.DIST_L2, 0, 0.01, 0.01).ravel()
+
+def drawLine(image,line,points):
+    '''
+    Draw line found by searchingBox and its searching area.
+    Called after the whole classic processing, so the ROIs are taken from the clear frame.
+    '''
+    vx,vy,x,y = line
+    if(vx == -1 and vy == -1): return # Line not found
 
     # Draw line 
     k = 10000
     p1 = (int(x - k*vx), int(y - k * vy))
     p2 = (int(x + k*vx), int(y + k * vy))
-    cv.line(img, p1,p2 , (255,255,255), 3, cv.LINE_AA, 0)
-    cv.rectangle(img,(points[0],points[1],points[2],points[3]),(255,255,255),2)
-    
-    # Show ROI and fitted line on the orgnial image
-    showResizedImg(img,'Image',scale = 0.5 )
-    return line 
+    cv.line(image, p1,p2 , (255,255,255), 3, cv.LINE_AA, 0)
+    cv.rectangle(image,(points[0],points[1],points[2],points[3]),(255,255,255),2)
 
-def findArcPoint(image,line1,line2):
+def findArcPoint(image,line1,line2,pipeline):
     '''
     Finding centre of the cutting insert arc basing on previously calculated lines.
     Extract region with the arc. Apply polar transform to straighten it.
@@ -159,40 +269,29 @@ def findArcPoint(image,line1,line2):
     Decide if the insert is good or faulty (classic approach).
     '''
     
-    # Solving linear equation to find lines crossing point
-    vx1,vy1,x1,y1 = line1
-    vx2,vy2,x2,y2 = line2
-    A = np.array([[vx1, 0, -1,0], [vy1, 0, 0,-1], [0, vx2, -1,0], [0, vy2, 0,-1]], dtype='float')
-    B = np.array([-x1,-y1,-x2,-y2], dtype='float')
-    R = np.linalg.inv(A).dot(B)
-    xs,ys = R[2:]
+    # Solving linear equation to find lines crossing point: p1 + t*d1 = p2 + u*d2
+    vx1,vy1,x1,y1 = map(float, np.ravel(line1))
+    vx2,vy2,x2,y2 = map(float, np.ravel(line2))
+    denom = vx1*vy2 - vy1*vx2
+    if(denom == 0):
+        print("Lines are parallel")
+        return -1
+    t = ((x2-x1)*vy2 - (y2-y1)*vx2)/denom
+    xs,ys = x1 + t*vx1, y1 + t*vy1
     rot_ang = math.atan2(vy2,vx2) 
     vy =  abs( vx1 +  vx2 ) if vy2 < 0 else abs( vy1 +  vy2 )
     vx = abs( vy1 +  vy2 ) if vy2 < 0 else abs( vx1 +  vx2 )
 
-    l = math.sqrt(vx**2 + vy**2) # lenght of those vectors
+    l = math.hypot(vx, vy) # lenght of those vectors
     k = (PX2MM*4)/l # how many vectors is between line crossing point and cutting insert arc centre
-    p1 = (int(xs + k*vx), int(ys + k * vy))
-    p2 = (int(xs ), int(ys ))
-    cv.line(img, p1,p2 , (255,255,255), 2, cv.LINE_AA, 0)
 
     # Find 4 possible arc centres of the cutting insert
-    C = [] # coortinates of the 4 possible arc centres
     v = np.array([[vx,vy],[-vx,vy],[-vx,-vy],[vx,-vy]], dtype='float')  # All possible direction of the vectors
-
-    for i in range(len(v)): # all possible configurations
-        pom = xs + v[i][0]*k  , ys + v[i][1]*k
-        cv.circle(img,(int(xs + v[i][0]*k),int(ys + v[i][1]*k)),1,(255,255,255),4) ### Visualization 
-        C.append(pom)
+    C = np.array([xs,ys]) + v*k # coortinates of the 4 possible arc centres
  
     # Chose ROI with contains cutting insert arc - closest to the centre of the image
-    min_dist = 9999
     img_cy,img_cx=img.shape[:2]
-    for i in range(len(v)):
-        dist = math.sqrt( (C[i][0]-img_cx/2)**2 +  (C[i][1]-img_cy/2)**2 )
-        if(  dist < min_dist):
-            min_dist = dist
-            properArc = i       
+    properArc = int(np.argmin(((C - (img_cx/2,img_cy/2))**2).sum(axis=1)))
     xc,yc=C[properArc] #proper arc centre coordinates
 
     # Build roi between arc centre (xc,yc) and lines crossing point (xs,ys) in dependece on their location 
@@ -201,34 +300,39 @@ def findArcPoint(image,line1,line2):
     ry0 = int(yc) if yc < ys else int(ys-inc)
     rxk = int(xc) if xc > xs else int(xs+inc) 
     ryk = int(yc) if yc > ys else int(ys+inc)
-    roi = image.copy()[ry0:ryk,rx0:rxk]
+    roi = image[ry0:ryk,rx0:rxk] # view, polarTransform reads it before anything is drawn
 
     # Rotate roi
     ang = 0
     if(xc>xs and yc<ys): ang = 90 
     elif(xc>xs and yc>ys): ang = 180 
     elif(xc<xs and yc>ys): ang = 270  
-    roi = ndimage.rotate(roi, ang)
-
-    ### Visualization ###
-    cv.circle(img,(int(R[2]),int(R[3])),int(PX2MM*4),(255,255,255),3) # Lines intersection
-    cv.circle(img,(int(xc),int(yc)),5,(255,255,255),3) # Arc centre
-    cv.circle(img,(int(xc),int(yc)),int(PX2MM*4/math.sqrt(2)),(255,255,255),2) # Arc radius
-    #showResizedImg(roi,'Arc ROI',scale = 1 ) ### Visualization 
-    showResizedImg(img,'Image',scale = 0.5 ) ### Visualization 
+    if(ang != 0): roi = cv.rotate(roi, ROTATIONS[ang])
     printTime("Find arc prep")
 
     # Polar transform and filtration
     try:
-        roi = polarTransform(roi,start_point=(0,0),r=(int(PX2MM*1),int(PX2MM*2.25)),theta=90,theta_inc=0.25)
+        roi = polarTransform(roi,start_point=(0,0),r=POLAR_R,theta=POLAR_THETA,theta_inc=POLAR_THETA_INC,
+                             out=pipeline.arc_buf)
     except:
-        roi = roi
+        roi = None
+
+    if DEBUG:
+        ### Visualization ###
+        cv.line(img, (int(xs + k*vx), int(ys + k * vy)), (int(xs), int(ys)), (255,255,255), 2, cv.LINE_AA, 0)
+        for c in C: cv.circle(img,(int(c[0]),int(c[1])),1,(255,255,255),4)
+        cv.circle(img,(int(xs),int(ys)),int(PX2MM*4),(255,255,255),3) # Lines intersection
+        cv.circle(img,(int(xc),int(yc)),5,(255,255,255),3) # Arc centre
+        cv.circle(img,(int(xc),int(yc)),int(PX2MM*4/math.sqrt(2)),(255,255,255),2) # Arc radius
+        showResizedImg(img,'Image',scale = 0.5 )
+
+    if(roi is None):
         print("Can't find cutting insert arc")
         return -1
     #showResizedImg(roi,'Arc ROI after polar transform',scale = 2 )
 
     #Find edge on the image after polarTransform
-    ret,roi2 = cv.threshold(roi,150,255,cv.THRESH_TOZERO)
+    ret,roi2 = cv.threshold(roi,LINE_THRESH,255,cv.THRESH_TOZERO)
     roi2 = linesFiltration(roi2,(0,-1))
     pts = findLinesPoints(roi2,(0,1))
 
@@ -236,8 +340,7 @@ def findArcPoint(image,line1,line2):
         print("Any line found")
         return -1
     else: 
-        pts_y = []
-        for i in range(len(pts)): pts_y.append(pts[i][0][1])
+        pts_y = pts[:,0,1].astype(np.float32)
         statatistics = ExamineArc
 
         s = statatistics.srednia(pts_y) 
@@ -252,36 +355,42 @@ def findArcPoint(image,line1,line2):
     #showResizedImg(roi2,'Binary Arc',scale = 3 ) ### Visualization 
     return 0
 
-def polarTransform(roi,start_point,r,theta,theta_inc):
+def polarTransform(roi,start_point,r,theta,theta_inc,out=None):
     '''
     Transform cutting inserts arc curve into polar coordinates.
     Use custom angle and range.
+    Rows of the output are radii, columns are angles (alpha = 0 along the x axis).
+    Any theta_inc is handled by the cached remap maps, so no compiled loop fallback is needed.
+    Result is written to the out buffer if it is given.
     '''
-    
-    drawing = np.zeros((roi.shape[0], roi.shape[1]), dtype=np.uint8)
-    roi2 = np.zeros((int(r[1]-r[0]),int(theta/theta_inc)+1), dtype=np.uint8)
-    theta_range = np.arange(0, theta, theta_inc)
+    maps, max_x, max_y = polarMaps(start_point, r, theta, theta_inc)
+    if(roi.shape[0] <= max_x or roi.shape[1] <= max_y):
+        raise ValueError("ROI is too small for the polar transform")
+    return cv.remap(roi, maps, None, cv.INTER_NEAREST, out, cv.BORDER_CONSTANT, 0)
 
-    for alpha in theta_range:
-        x0 = int(math.sin(math.radians(alpha))*r[0])
-        y0 = int(math.cos(math.radians(alpha))*r[0])
-  
-        roid = cv.cvtColor(roi,cv.COLOR_GRAY2BGR)
-        
-        for R in range(r[0],r[1]):
-            x = int(math.sin(math.radians(alpha))*R)+x0
-            y = int(math.cos(math.radians(alpha))*R)+y0
-        
-            #roi2[R-r[0],int(alpha/theta_inc)] = roi[x,y]
-            roi2.itemset( R-r[0] , int(alpha/theta_inc) , roi.item(x,y) ) 
-
-            # Debuging and demonstrating pourposed display transforma row by row
-            '''cv.circle(drawing,(x,y),1,(0,0,255),1)
-            drawing = cv.bitwise_or(drawing, roid)
-            showResizedImg(drawing,'Polar lines',scale = 1 ) ### Visualization 
-            showResizedImg(roi2,'Polar ROI',scale = 1 ) ### Visualization 
-            cv.waitKey(1)'''
-    return roi2  
+@lru_cache(maxsize=None)
+def polarMaps(start_point,r,theta,theta_inc):
+    '''
+    Sampling maps of the polarTransform, computed once for each set of parameters.
+    Trig tables are needed only here, so they are not kept at the module level.
+    Reproduce truncated sampling of the original pixel loop: radius R is sampled at int(sin*R)+int(sin*r0).
+    Return maps for cv.remap and the max row (x) and column (y) index which they read.
+    '''
+    theta_range = np.arange(0, theta, theta_inc)
+    sins = np.array([math.sin(math.radians(alpha)) for alpha in theta_range])
+    coss = np.array([math.cos(math.radians(alpha)) for alpha in theta_range])
+    R = np.arange(r[0], r[1])[:,None]
+    x = np.trunc(sins*R) + np.trunc(sins*r[0]) + start_point[1]
+    y = np.trunc(coss*R) + np.trunc(coss*r[0]) + start_point[0]
+
+    # Columns not hit by any alpha (e.g. the last one) stay empty as in the original loop
+    map_x = np.full((len(R),int(theta/theta_inc)+1), -1, dtype=np.float32)
+    map_y = np.full(map_x.shape, -1, dtype=np.float32)
+    for a, alpha in enumerate(theta_range):
+        map_x[:,int(alpha/theta_inc)] = x[:,a]
+        map_y[:,int(alpha/theta_inc)] = y[:,a]
+    maps, _ = cv.convertMaps(map_y, map_x, cv.CV_16SC2) # remap takes (column, row) maps
+    return maps, int(x.max()), int(y.max())
 
 # Output analyze
 class ExamineArc:
@@ -290,29 +399,24 @@ class ExamineArc:
     '''
 
     def srednia(pts):
-        suma = sum(pts)
-        return suma / float(len(pts))
+        return float(np.mean(pts))
     
     def mediana(pts):
-        pts.sort()
-        if len(pts) % 2 == 0:  
-            half = int(len(pts) / 2)
-            return float(sum(pts[half - 1:half + 1])) / 2.0
-        else: 
-            return pts[int(len(pts) / 2)]
+        return float(np.median(pts))
 
     def wariancja(pts, srednia):
-        sigma = 0.0
-        for ocena in pts:
-            sigma += (ocena - srednia)**2
-        return sigma / len(pts)
+        return float(np.mean((np.asarray(pts) - srednia)**2))
 
     def odchylenie(pts, srednia): 
         w = ExamineArc.wariancja(pts, srednia)
         return math.sqrt(w) 
 
 # Deep learning clasification
-def deepL(orgImg):
+def deepL(orgImg,frame_id):
+    '''
+    Prepare the image for the neural network and pass it to the deepLWorker thread.
+    Result is put on the image by showDeepL.
+    '''
   
     #Define ROI 
     XC,YC = 1480,1220
@@ -320,21 +424,67 @@ def deepL(orgImg):
     end_point = (XC, YC)
     start_point = (int(XC-Xdim), int(YC-Ydim))
     deepL_img = orgImg[start_point[1]:end_point[1],start_point[0]:end_point[0]]
-    deepL_img = cv.resize(deepL_img, (224,224), interpolation = cv.INTER_AREA)
+    deepL_img = cv.resize(deepL_img, (224,224), interpolation = cv.INTER_LINEAR)
+    deepL_img = cv.cvtColor(deepL_img, cv.COLOR_GRAY2BGR) # Network expects 3 channels
+
+    # Clasification - normalize (and quantize input of the int8 model) in place
+    x = deepL_img.astype(np.float32)
+    x *= in_mul
+    if in_details['dtype'] == np.uint8:
+        x += in_add
+        x = np.clip(np.rint(x, out=x), 0, 255, out=x).astype(np.uint8)
+    image_tensor = x[None, ...]
+    dl_in.put((frame_id, image_tensor))
+
+def deepLWorker():
+    '''
+    Run the model inference in the background, so the classic algorithm doesn't wait for it.
+    Interpreter is used only by this thread.
+    '''
+    while True:
+        frame_id, image_tensor = dl_in.get()
+        interp.set_tensor(in_details['index'], image_tensor)
+        interp.invoke()
+        dl_out.put((frame_id, interp.get_tensor(out_idx)))
 
-    # Clasification
-    classification = []
-    x = deepL_img.astype(np.float32)/255
-    x = np.expand_dims(x, axis=0)
-    image_tensor = np.vstack([x])
-    classes = model.predict(image_tensor)
+def showDeepL(image,frame_id):
+    '''
+    Put clasification result of the frame on the image if it is already available.
+    Results of the older frames are dropped. Return True if the result was put.
+    '''
+    while True:
+        try:
+            result_id, classes = dl_out.get_nowait()
+        except queue.Empty:
+            return False
+        if result_id == frame_id: break
 
     if classes > 0.5:
         title =  "is good  " + str(round(float((classes)*100),2)) + "%"
     else:
         title =  "is faulty  " + str(round(float((1-classes)*100),2)) + "%"
     print(title)
-    cv.putText(img,title,(100,300), cv.FONT_HERSHEY_PLAIN, 5,255,2)
+    cv.putText(image,title,(100,300), cv.FONT_HERSHEY_PLAIN, 5,255,2)
+    return True
+
+# Camera
+def grabFrames():
+    '''
+    Grab and convert frames in the background while the main loop computes the previous one.
+    Older frame waiting in the queue is dropped to always provide the latest one.
+    '''
+    while camera.IsGrabbing() and not stop_grabbing.is_set():
+        grabResult = camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
+        if grabResult.GrabSucceeded():
+            # Access the image data
+            image = converter.Convert(grabResult)
+            frame = image.GetArray()
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                pass
+            frames.put_nowait(frame)
+        grabResult.Release()
 
 # Displaying
 def showResizedImg(image,windowName="Deep Learning Clasification",scale=1):
@@ -351,21 +501,21 @@ def printTime(str='Deep learning clasificatrion time'):
 
 
 #--------------------Main-loop---------------------#
+grab_thread = threading.Thread(target=grabFrames, daemon=True)
+grab_thread.start()
+threading.Thread(target=deepLWorker, daemon=True).start()
+frame_id = 0
+pipeline = Pipeline()
+
 while camera.IsGrabbing():
-    grabResult = camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
-
-    if grabResult.GrabSucceeded():
-        # Access the image data
-        image = converter.Convert(grabResult)
-        img = image.GetArray()
-    grabResult.Release()
-
-    # Drawing rectangles on the pre-captured image for better positioning
-    img3 = img.copy() # Keep clear frame for deep learning
-    cv.rectangle(img,(1000,625,800,200),(255,255,255),2) # Draw positioning rectangles
-    cv.rectangle(img,(325,1075,300,300),(255,255,255),2)
-    showResizedImg(img,'Image',scale = 0.5 ) ### Visualization 
-    img = img3.copy() # Restore clear frame
+    # Latest frame from the grabbing thread
+    img = frames.get(timeout=5)
+
+    # Drawing rectangles on the preview of the pre-captured image for better positioning
+    overlay = pipeline.overlay(img)
+    cv.rectangle(overlay,(1000,625,800,200),(255,255,255),2) # Draw positioning rectangles
+    cv.rectangle(overlay,(325,1075,300,300),(255,255,255),2)
+    showResizedImg(overlay,'Image',scale = 0.5 ) ### Visualization 
     
     # Get key from user ESC-break SPACE-process frame
     key = cv.waitKey(1)
@@ -376,40 +526,38 @@ while camera.IsGrabbing():
     # Frame processing
     if key == 32:
         start_time = time.time()
+        frame_id += 1
 
-        # If there is an image convert it to grayscale
-        try:
-            img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-            img2 = img.copy() # Backup clear frame    
-        except:
-            print("Image not found")
-            sys.exit(1) 
-        showResizedImg(img,'Image',scale = 0.5 ) ### Visualization 
+        # DeepL clacification runs in the background during classic processing
+        deepL(img,frame_id) # Uses clear frame, before anything is drawn on it
         printTime("Grabbing frame")
         
         # Detect lines
         line1 = searchingBox(img,(1000,625,800,200),(0,1))
-        showResizedImg(img,'Image',scale = 0.5 ) ### Visualization 
-        cv.waitKey(1)
         line2 = searchingBox(img,(325,1075,300,300),(1,0))
-        showResizedImg(img,'Image',scale = 0.5 ) ### Visualization 
-        cv.waitKey(1)
         printTime("Detecting lines") 
 
-        # Find and examine edge
-        findArcPoint(img2,line1,line2)
-        showResizedImg(img,'Image',scale = 0.5 ) ### Visualization 
-        cv.waitKey(1)
+        # Find and examine edge (intermediate steps are shown only in DEBUG mode)
+        findArcPoint(img,line1,line2,pipeline)
+        if DEBUG: cv.waitKey(1)
         printTime("Examine edge") 
 
-        # DeepL clacification
-        deepL(img3)
-        showResizedImg(img,'Image',scale = 0.5 ) ### Visualization  
-        printTime("DeepL Time")
+        # Draw lines when all ROIs have been read from the clear frame
+        drawLine(img,line1,(1000,625,800,200))
+        drawLine(img,line2,(325,1075,300,300))
 
-        cv.waitKey(0)
+        # Wait for the user, put DeepL result on the image as soon as it arrives
+        showResizedImg(img,'Image',scale = 0.5 ) ### Visualization  
+        dl_shown = False
+        while cv.waitKey(30) == -1:
+            if not dl_shown and showDeepL(img,frame_id):
+                dl_shown = True
+                showResizedImg(img,'Image',scale = 0.5 ) ### Visualization  
+                printTime("DeepL Time")
         cv.destroyAllWindows()
 #-----------------Main-loop-end--------------------#
     
 # Releasing the resource    
+stop_grabbing.set()
+grab_thread.join()
 camera.StopGrabbing()
\ No newline at end of file
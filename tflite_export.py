@@ -0,0 +1,60 @@
+import cv2 as cv
+import numpy as np
+import os
+import tensorflow as tf
+
+'''
+Convert Keras model prepared in Google Colab to TFLite flatbuffer used by stand_image_processing.py.
+Weights are quantized to int8 and float16 (post-training quantization).
+stand_image_processing.py picks the one which is faster on the target.
+Validation images prepared by split.py are used as a representative dataset.
+'''
+
+
+# Keras model paths
+MODEL_JSON = 'model.json'
+MODEL_WEIGHTS = 'model.h5'
+
+# Output models paths
+MODEL_INT8 = 'model_int8.tflite'
+MODEL_FP16 = 'model_fp16.tflite'
+
+# Representative images paths
+PATHS = ('validation\\samples_good\\','validation\\samples_faulty\\')
+SAMPLES = 100 # Max number of images used for the calibration
+
+
+def representativeDataset():
+    '''
+    Yield images prepared the same way as in deepL function.
+    '''
+    files = [os.path.join(dir, f) for dir in PATHS for f in os.listdir(dir)]
+    for filePath in files[:SAMPLES]:
+        img = cv.imread(filePath)
+        img = cv.resize(img, (224,224), interpolation = cv.INTER_LINEAR)
+        x = img.astype(np.float32)/255
+        yield [np.expand_dims(x, axis=0)]
+
+
+# Load Keras model
+with open(MODEL_JSON, 'r') as json_file:
+    model = tf.keras.models.model_from_json(json_file.read())
+model.load_weights(MODEL_WEIGHTS)
+
+# Convert to int8
+converter = tf.lite.TFLiteConverter.from_keras_model(model)
+converter.optimizations = [tf.lite.Optimize.DEFAULT]
+converter.representative_dataset = representativeDataset
+converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+converter.inference_input_type = tf.uint8
+with open(MODEL_INT8, 'wb') as f:
+    f.write(converter.convert())
+print("Model saved to", MODEL_INT8)
+
+# Convert to float16
+converter = tf.lite.TFLiteConverter.from_keras_model(model)
+converter.optimizations = [tf.lite.Optimize.DEFAULT]
+converter.target_spec.supported_types = [tf.float16]
+with open(MODEL_FP16, 'wb') as f:
+    f.write(converter.convert())
+print("Model saved to", MODEL_FP16)